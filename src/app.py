@@ -2,6 +2,10 @@
 # ::::::::::::::::::::::: IMPORTS :::::::::::::::::::::::::::::
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 import os
+import io
+import time
+import threading
+import tempfile
 import dash
 from dash import dcc, html, Input, Output
 import dash_leaflet as dl
@@ -12,14 +16,19 @@ from dash import Dash
 import rioxarray as rxr
 import numpy as np
 import pandas as pd
-from datetime import datetime
+import hashlib
 import matplotlib.pyplot as plt
 from matplotlib import colors
 from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rio_tiler.io import Reader
+from rio_tiler.errors import TileOutsideBounds
 from PIL import Image
-import dask.array as da
+from numba import njit, prange
+from flask import Response, abort, request, send_file
 from flask_caching import Cache
-import json
+from build_layers import build_layer_stack, layer_stack_is_current, LAYER_STACK_PATH
 
 
 
@@ -46,14 +55,27 @@ cache = Cache(app.server, config={"CACHE_TYPE": "SimpleCache"})
 
 # Load the data with caching
 def load_raster(file_path):
-    """Load raster data using Dask."""
-    return rxr.open_rasterio(file_path, chunks="auto").squeeze()
+    """Load raster data without Dask, the layers are small enough to read whole."""
+    return rxr.open_rasterio(file_path, chunks=None).squeeze()
+
+def load_layer_stack(data_list):
+    """Memory-map the stacked factor layers, building the stack first if it is missing or stale."""
+    # Stale means built from other layer files, in another order, or before a source changed
+    if not layer_stack_is_current(data_list, LAYER_STACK_PATH):
+        build_layer_stack(data_list, LAYER_STACK_PATH)
+    return np.load(LAYER_STACK_PATH, mmap_mode="r")
 
 @cache.memoize(timeout=300)  # Cache for 5 minutes
 def load_data_list(file_path):
     """Load data list from an Excel file."""
     return pd.read_excel(file_path)
 
+def get_blank_tile(size=256):
+    """Return a transparent PNG tile, served for tiles outside the result raster."""
+    buffer = io.BytesIO()
+    Image.new("RGBA", (size, size)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
 @cache.memoize(timeout=300)  # Cache for 5 minutes
 def get_jet_colorscale(n_colors=10):
     cmap = plt.get_cmap('jet')
@@ -65,26 +87,89 @@ def get_jet_colorscale(n_colors=10):
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 SELECTED_FONT_CSS = "'Poppins', sans-serif"
 VRI_LOGO_PATH = "/assets/images/VRI_logo.png"
-CESIS_KAD_GEOJSON = "assets/geojson/Cesis_kad.geojson"
+GEOJSON_PATH = "assets/geojson"
+CESIS_KAD_GEOJSON_URL = "/geojson/Cesis_kad.geojson"
 CESIS_ROAD_GEOJSON = "/assets/geojson/Cesis_road4.geojson"
 STATIC_PATH = "static"
 os.makedirs(STATIC_PATH, exist_ok=True)
 COLORSCALE = get_jet_colorscale()
+JET_LUT = (plt.get_cmap('jet')(np.arange(256)) * 255).astype(np.uint8)  # 256-entry RGBA lookup table
+JET_COLORMAP = {i: tuple(rgba) for i, rgba in enumerate(JET_LUT.tolist())}  # Colormap for rio-tiler
+DEFAULT_POS_FACTORS = ["Ainavas atvērtums"]
 CORRECT_BOUNDS = [[57.507346438, 24.77478809], [56.91368127, 26.189455607999996]]
+BLANK_TILE = get_blank_tile()
+BLANK_TILE_URL = "/tiles/blank.png"  # Every tile of an empty selection
+RENDER_VERSION = 2  # Bump whenever the same selection would render differently
+RESULT_TIMEOUT = 3600  # Seconds a rendered selection stays memoized
+RESULT_CACHE_BYTES = 256 * 1024 * 1024  # Disk budget for result COGs in the static folder
 
 
 data_list = load_data_list('Layers/HH_layers.xlsx')
 data_keys = list(data_list.Name)
-base_raster = load_raster('Layers/10301.tif')
+LAYER_INDEX = {name: i for i, name in enumerate(data_list.Name)}  # Position in the layer stack
+COMMENT_BY_NAME = dict(zip(data_list.Name, data_list.Comment))
+layers = load_layer_stack(data_list)
+# Result names also depend on the layer stack, so a rebuilt stack never reuses old files
+_stack_stat = os.stat(LAYER_STACK_PATH)
+RESULT_SALT = f"{RENDER_VERSION}:{_stack_stat.st_size}:{_stack_stat.st_mtime_ns}"
+base_raster = load_raster('Layers/10301.tif').load()
 base_raster.data[base_raster.data >= 0] = 0
-base_raster = base_raster.astype(np.float64)
+base_raster = base_raster.astype(np.float32)
+
+# Georeferencing shared by every render, the base raster never changes
+BASE_BOUNDS = base_raster.rio.bounds()
+BASE_CRS = base_raster.rio.crs
+PIXEL_WIDTH = (BASE_BOUNDS[2] - BASE_BOUNDS[0]) / base_raster.shape[1]
+PIXEL_HEIGHT = (BASE_BOUNDS[3] - BASE_BOUNDS[1]) / base_raster.shape[0]
+
+# Buffers reused by every render instead of allocating full rasters per callback
+_SCRATCH = np.empty(base_raster.shape, dtype=np.int32)
+_INDEX = np.empty(base_raster.shape, dtype=np.uint8)
+_ROW_START = np.empty(base_raster.shape[0], dtype=np.int64)
+_ROW_END = np.empty(base_raster.shape[0], dtype=np.int64)
+_SCRATCH_LOCK = threading.Lock()
 
-with open(CESIS_KAD_GEOJSON, 'r', encoding='utf-8') as f:
-    cesis_kad_data = json.load(f)
+# :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::: NUMBA KERNELS :::::::::::::::::::::::
+# :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+@njit(parallel=True, cache=True)
+def accumulate_layers(layers, indices, signs, out):
+    """Write the signed sum of the indexed layers, clipped at zero, to out and return its maximum."""
+    n_layers = indices.shape[0]
+    height, width = out.shape
+    row_max = np.zeros(height, dtype=np.int32)
+    for row in prange(height):
+        for col in range(width):
+            total = 0
+            for i in range(n_layers):
+                total += signs[i] * layers[indices[i], row, col]
+            total = max(total, 0)  # Mask negative values
+            out[row, col] = total
+            row_max[row] = max(row_max[row], total)
+    return row_max.max()
+
+@njit(parallel=True, cache=True)
+def bin_layers(data, data_max, threshold, n_colours, out, row_start, row_end):
+    """Normalize and threshold data into colormap indices, recording each row's significant columns."""
+    # The sums are integers, so normalization and the percentage threshold are
+    # compared exactly by cross-multiplying instead of dividing by data_max
+    height, width = data.shape
+    for row in prange(height):
+        row_start[row] = width
+        row_end[row] = -1
+        if data_max <= 0:  # Nothing is significant, e.g. only negative factors are selected
+            out[row, :] = 0
+            continue
+        for col in range(width):
+            value = data[row, col]
+            if value <= 0 or value * 100 < threshold * data_max:
+                out[row, col] = 0  # Nodata, rendered transparent
+            else:
+                # Bin like matplotlib does, index 0 is reserved for nodata
+                out[row, col] = max(min(value * n_colours // data_max, n_colours - 1), 1)
+                row_start[row] = min(row_start[row], col)
+                row_end[row] = col
 
-# Debugging:
-# print(cesis_kad_data["features"][0]["properties"])
-# print(cesis_kad_data) 
 
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 # ::::::::::::::::::::::: JS FUNCTIONS ::::::::::::::::::::::::
@@ -161,7 +246,7 @@ app.layout = dbc.Container([
                 id="pos-factors",
                 options=[{"label": key, "value": key} for key in data_keys],
                 multi=True,
-                value=["Ainavas atvērtums"]
+                value=DEFAULT_POS_FACTORS
             ),
 
             html.H6("Negatīvie faktori (-1):",
@@ -250,7 +335,7 @@ app.layout = dbc.Container([
                             # ::::::::::::::::::::::: RESULT LAYER AND GEOJSON FILES ::::::::::::::::::::::
                             dl.Overlay(
                                 dl.GeoJSON(
-                                    data=cesis_kad_data,
+                                    url=CESIS_KAD_GEOJSON_URL,
                                     id="cesis-kad-overlay",
                                     options={
                                         "style": {
@@ -280,11 +365,12 @@ app.layout = dbc.Container([
                             ),
 
                             dl.Overlay(
-                                dl.ImageOverlay(
+                                dl.TileLayer(
                                     id="raster-overlay",
-                                    url="/static/default_raster.webp",
+                                    url="/tiles/default_raster/{z}/{x}/{y}.png",
                                     bounds=CORRECT_BOUNDS,
-                                    opacity=0.5
+                                    opacity=0.5,
+                                    zIndex=10  # Keep above the base layers
                                 ),
                                 name="Dzīvotnes Kartējums",
                                 checked=True
@@ -341,112 +427,210 @@ app.layout = dbc.Container([
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 # ::::::::::::::::::::::: FUNCTIONALITY :::::::::::::::::::::::
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+def render_cog(pos_factors, neg_factors, data_threshold):
+    """Combine the selected layers and encode the result as Cloud-Optimized GeoTIFF bytes."""
+    factors = pos_factors + neg_factors
+
+    # The scratch buffers are shared, so only one render may use them at a time
+    with _SCRATCH_LOCK:
+        # Sum the selected layers with +1/-1 signs, then normalize, threshold and
+        # bin the result into colormap indices in one more fused pass
+        indices = np.array([LAYER_INDEX[factor] for factor in factors], dtype=np.int64)
+        signs = np.array([1] * len(pos_factors) + [-1] * len(neg_factors), dtype=np.int8)
+        A_max = accumulate_layers(layers, indices, signs, _SCRATCH)
+        bin_layers(_SCRATCH, A_max, int(data_threshold), len(JET_LUT), _INDEX, _ROW_START, _ROW_END)
+
+        # Crop to the bounding box of significant values
+        significant_rows = np.flatnonzero(_ROW_END >= 0)
+        if significant_rows.size > 0:
+            min_row, max_row = significant_rows[0], significant_rows[-1]
+            min_col, max_col = _ROW_START[significant_rows].min(), _ROW_END[significant_rows].max()
+
+            # Crop the index raster to the bounding box
+            A_cropped = _INDEX[min_row:max_row+1, min_col:max_col+1]
+        else:
+            A_cropped = _INDEX  # Fallback to the original data
+            min_row = min_col = 0
+
+        A_cropped = A_cropped.copy()  # Copy out of the shared buffer
+        transform = from_origin(
+            BASE_BOUNDS[0] + min_col * PIXEL_WIDTH, BASE_BOUNDS[3] - min_row * PIXEL_HEIGHT,
+            PIXEL_WIDTH, PIXEL_HEIGHT
+        )
+
+    # Encode the cropped raster as a COG with 256x256 internal tiles and overviews,
+    # so the tile endpoint only reads the blocks a map tile needs
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="COG",
+            width=A_cropped.shape[1], height=A_cropped.shape[0],
+            count=1, dtype="uint8", nodata=0,
+            crs=BASE_CRS, transform=transform,
+            compress="ZSTD", level=1, blocksize=256,
+            overviews="AUTO", resampling="NEAREST",
+        ) as dst:
+            dst.write(A_cropped, 1)
+        return memfile.read()
+
+
+def write_cog(name, cog_bytes):
+    """Save COG bytes to the static folder under name, replacing any previous file atomically."""
+    cog_path = os.path.join(STATIC_PATH, name + ".tif")
+    # Write to a unique temporary file first so tile requests never read a partial COG,
+    # even when two threads render the same selection at once
+    fd, tmp_path = tempfile.mkstemp(prefix=name + ".", suffix=".tif.tmp", dir=STATIC_PATH)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(cog_bytes)
+        os.replace(tmp_path, cog_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def evict_results():
+    """Delete the least recently used result COGs once they exceed RESULT_CACHE_BYTES."""
+    now = time.time()
+    results = []
+    for entry in os.scandir(STATIC_PATH):
+        if entry.name == "default_raster.tif":
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:  # Removed by another thread or worker
+            continue
+        if entry.name.endswith(".tif.tmp"):
+            # Left behind by an interrupted write, live writes finish within seconds
+            if now - stat.st_mtime > RESULT_TIMEOUT:
+                results.append((stat.st_mtime, 0, entry.path))
+        elif entry.name.endswith(".tif"):
+            results.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in results)
+    for mtime, size, path in sorted(results):
+        if now - mtime < RESULT_TIMEOUT:
+            break  # Used within the memoize timeout, so it and newer files may still be shown
+        if size > 0 and total <= RESULT_CACHE_BYTES:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+@server.route("/tiles/<name>/<int:z>/<int:x>/<int:y>.png")
+def serve_tile(name, z, x, y):
+    """Render one web mercator tile of a COG from the static folder with the jet colormap."""
+    cog_path = os.path.join(STATIC_PATH, name + ".tif")
+    if not os.path.isfile(cog_path):
+        abort(404)
+    try:
+        with Reader(cog_path) as cog:
+            tile = cog.tile(x, y, z)
+        response = Response(tile.render(img_format="PNG", colormap=JET_COLORMAP), mimetype="image/png")
+    except TileOutsideBounds:
+        response = Response(BLANK_TILE, mimetype="image/png")
+    # Result names are content hashes and the default only changes on deploy, so tiles can be cached
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response
+
+
+@server.route(BLANK_TILE_URL)
+def serve_blank_tile():
+    """Serve the transparent tile shown while no factors are selected."""
+    response = Response(BLANK_TILE, mimetype="image/png")
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response
+
+
+@cache.memoize(timeout=RESULT_TIMEOUT)
+def render_result(pos_factors, neg_factors, data_threshold):
+    """Return the COG name for a selection, rendering it only if its file does not exist yet."""
+    # Name the file after its inputs and the render version so identical selections
+    # share one URL and one file, while files from older renders are never reused
+    key = repr((RESULT_SALT, pos_factors, neg_factors, data_threshold)).encode()
+    name = hashlib.blake2b(key, digest_size=8).hexdigest()
+    cog_path = os.path.join(STATIC_PATH, name + ".tif")
+
+    try:  # Rendered earlier, possibly by another worker
+        os.utime(cog_path)  # Mark as recently used for eviction
+        return name
+    except FileNotFoundError:
+        pass
+
+    write_cog(name, render_cog(pos_factors, neg_factors, data_threshold))
+    evict_results()
+    return name
+
+
+@server.route("/geojson/<name>.geojson")
+def serve_geojson(name):
+    """Serve a GeoJSON asset, sending its pre-gzipped copy to browsers that accept gzip."""
+    geojson_path = os.path.join(GEOJSON_PATH, name + ".geojson")
+    if not os.path.isfile(geojson_path):
+        abort(404)
+    # The copy is written by build_geojson.py, fall back to the plain file if it is missing or stale
+    gz_path = geojson_path + ".gz"
+    gz_current = os.path.isfile(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(geojson_path)
+    if "gzip" not in request.accept_encodings or not gz_current:
+        return send_file(geojson_path, mimetype="application/json")
+    response = send_file(gz_path, mimetype="application/json")
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+# Render the initial selection on start-up so the default tiles always exist
+write_cog("default_raster", render_cog(tuple(DEFAULT_POS_FACTORS), (), 0))
+
+
+# Transparency only changes the layer opacity, so it is applied in the browser
+app.clientside_callback(
+    "function(transparency) { return transparency; }",
+    Output("raster-overlay", "opacity"),
+    Input("layer-transparency", "value")
+)
+
+
 @app.callback(
+    # TileLayer only applies url, opacity and zIndex updates, its bounds stay CORRECT_BOUNDS
     [Output("raster-overlay", "url"),
-     Output("raster-overlay", "bounds"),
-     Output("raster-overlay", "opacity"),
      Output("factors-description", "children")],
     [Input("pos-factors", "value"),
      Input("neg-factors", "value"),
-     Input("layer-transparency", "value"),
      Input("data-threshold", "value")]
 )
-def update_map(pos_factors, neg_factors, transparency, data_threshold):
+def update_map(pos_factors, neg_factors, data_threshold):
     if not pos_factors and not neg_factors:
-        return "", [[56.0, 24.0], [58.0, 26.0]], transparency, "No factors selected."
+        return BLANK_TILE_URL, "No factors selected."
 
-    A = base_raster.copy()
-    n = 0
+    output_name = render_result(
+        tuple(sorted(pos_factors or [])),
+        tuple(sorted(neg_factors or [])),
+        data_threshold
+    )
 
-    if pos_factors:
-        for factor in pos_factors:
-            filename = 'Layers/' + data_list.Layer[data_list.Name == factor].values[0]
-            B = load_raster(filename)
-            A.data += B.data
-            n += 1
+    # The name changes with the content, so browsers can cache the tiles
+    image_url = f"/tiles/{output_name}/{{z}}/{{x}}/{{y}}.png"
 
-    if neg_factors:
-        for factor in neg_factors:
-            filename = 'Layers/' + data_list.Layer[data_list.Name == factor].values[0]
-            B = load_raster(filename)
-            A.data -= B.data
-            n += 1
-
-    if n > 0:
-        A.data /= n
-    A.data[A.data < 0] = 0  # Mask negative values
-    A_max = A.data.max()
-
-    # Normalize the data to range 0-1 for the colormap
-    normalized_data = A.data / A_max
-
-    # Apply a threshold to remove dead zones
-    threshold = data_threshold / 100.0  # Convert percentage to range 0-1
-    normalized_data[normalized_data < threshold] = 0
-
-    # Set insignificant areas to transparent
-    colormap = plt.get_cmap("jet")  # Jet colormap
-    A_rgba = colormap(normalized_data)  # Apply colormap to normalized data
-    A_rgba[..., 3] = (normalized_data > 0).astype(float)  # Set alpha channel based on significance
-
-    # Crop to the bounding box of significant values
-    nonzero_indices = np.argwhere(normalized_data > 0)
-    if nonzero_indices.size > 0:
-        min_row, min_col = nonzero_indices.min(axis=0)
-        max_row, max_col = nonzero_indices.max(axis=0)
-
-        # Crop the RGBA image to the bounding box
-        A_cropped = A_rgba[min_row:max_row+1, min_col:max_col+1]
-
-        # Calculate geographic bounds for the cropped raster
-        bounds = base_raster.rio.bounds()
-        pixel_width = (bounds[2] - bounds[0]) / A.shape[1]
-        pixel_height = (bounds[3] - bounds[1]) / A.shape[0]
-
-        # Correct the geographic bounds for leaflet (invert latitude and longitude)
-        cropped_bounds = [
-            [bounds[3] - (max_row + 1) * pixel_height, bounds[0] + min_col * pixel_width],
-            [bounds[3] - min_row * pixel_height, bounds[0] + (max_col + 1) * pixel_width],
-        ]
-    else:
-        A_cropped = A_rgba  # Fallback to the original data
-        bounds = base_raster.rio.bounds()
-        cropped_bounds = [
-            [bounds[3], bounds[0]],
-            [bounds[1], bounds[2]],
-        ]
-
-    # Save the cropped raster as a transparent image
-    output_filename = "output_raster.webp"
-    output_path = os.path.join(STATIC_PATH, output_filename)
-    img = Image.fromarray((A_cropped * 255).astype(np.uint8))
-    img.save(output_path, format="WEBP", quality=75)  # Faster saving and better compression
-
-    # Add a timestamp to force the browser to fetch the updated image
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    image_url = f"/static/{output_filename}?t={timestamp}"
-
-    # Generate description for selected factors
-    description = "**Pozitīvie faktori ar koeficienta vērtību +1:**  \n"
+    # Generate description for selected factors, joined once at the end
+    parts = ["**Pozitīvie faktori ar koeficienta vērtību +1:**  \n"]
     if pos_factors:
-        for factor in pos_factors: 
-            description += f"***- {factor}***  \n"
-            description += data_list.Comment[data_list.Name == factor].values[0] + "  \n"
+        parts.extend(f"***- {factor}***  \n{COMMENT_BY_NAME[factor]}  \n" for factor in pos_factors)
     else:
-        description += "- Nav izvēlēts neviens  \n"
-    
-    description += "  \n**Negatīvie faktori ar koeficienta vērtību -1:**  \n"
+        parts.append("- Nav izvēlēts neviens  \n")
+
+    parts.append("  \n**Negatīvie faktori ar koeficienta vērtību -1:**  \n")
     if neg_factors:
-        for factor in neg_factors:
-            description += f"***- {factor}***  \n"
-            description += data_list.Comment[data_list.Name == factor].values[0] + "  \n"
+        parts.extend(f"***- {factor}***  \n{COMMENT_BY_NAME[factor]}  \n" for factor in neg_factors)
     else:
-        description += "- Nav izvēlēts neviens"
-
-    # DEBUGGING:
-    # print(cropped_bounds)
+        parts.append("- Nav izvēlēts neviens")
+    description = "".join(parts)
 
-    return image_url, cropped_bounds, transparency, description
+    return image_url, description
 
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
 # ::::::::::::::::::::::: APP EXECUTION :::::::::::::::::::::::
@@ -0,0 +1,36 @@
+# :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::: GEOJSON GZIP BUILD STEP :::::::::::::::::
+# :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# Writes a gzipped copy next to each GeoJSON served by the app's
+# /geojson route, so start-up never pays for compressing them.
+# The app falls back to the plain file when no copy exists.
+# Run from the src directory: python build_geojson.py
+import gzip
+import os
+import shutil
+import tempfile
+
+GEOJSON_FILES = ["assets/geojson/Cesis_kad.geojson"]
+
+
+def gzip_file(file_path):
+    """Write a gzipped copy of a file next to it, unless an up-to-date copy already exists."""
+    gz_path = file_path + ".gz"
+    if os.path.isfile(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(file_path):
+        return
+    # A unique temporary file keeps concurrent builds from truncating each other's output
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(file_path) + ".", suffix=".gz.tmp", dir=os.path.dirname(file_path)
+    )
+    try:
+        with open(file_path, 'rb') as src, os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, gz_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+if __name__ == "__main__":
+    for geojson_file in GEOJSON_FILES:
+        gzip_file(geojson_file)
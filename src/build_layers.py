@@ -0,0 +1,83 @@
+# :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::: LAYER STACK BUILD STEP ::::::::::::::::::
+# :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# Packs every factor GeoTIFF listed in HH_layers.xlsx into one
+# (n_factors, rows, cols) uint8 .npy file, in the order of the list,
+# so the app can memory-map all layers instead of decoding TIFFs.
+# The ordered layer filenames are written to a sidecar text file so a
+# stack built from a different or reordered list is never reused.
+# Run from the src directory: python build_layers.py
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import rioxarray as rxr
+
+DATA_LIST_PATH = "Layers/HH_layers.xlsx"
+LAYER_STACK_PATH = "Layers/layers.npy"
+
+
+def layer_names_path(output_path):
+    """Path of the sidecar file listing the layer filenames of a stack."""
+    return os.path.splitext(output_path)[0] + ".txt"
+
+
+def layer_stack_is_current(data_list, output_path=LAYER_STACK_PATH):
+    """Check that the stack holds the layers of data_list in order and is newer than its sources."""
+    names_path = layer_names_path(output_path)
+    if not (os.path.isfile(output_path) and os.path.isfile(names_path)):
+        return False
+    with open(names_path, encoding="utf-8") as f:
+        if f.read().splitlines() != list(data_list.Layer):
+            return False
+    built = os.path.getmtime(output_path)
+    sources = [DATA_LIST_PATH] + ['Layers/' + layer for layer in data_list.Layer]
+    return all(os.path.getmtime(source) <= built for source in sources)
+
+
+def build_layer_stack(data_list, output_path=LAYER_STACK_PATH):
+    """Write the layers of data_list into a single uint8 .npy stack and its sidecar name list."""
+    names_path = layer_names_path(output_path)
+    if os.path.isfile(names_path):
+        os.remove(names_path)  # Until the new stack is complete it matches no list
+    filenames = ['Layers/' + layer for layer in data_list.Layer]
+    with rxr.open_rasterio(filenames[0]) as first:
+        height, width = first.shape[-2:]
+
+    # Build into a unique temporary file and swap it in, so processes that already
+    # memory-map the old stack keep reading it and concurrent builds never share a file
+    output_dir = os.path.dirname(output_path) or "."
+    fd, tmp_path = tempfile.mkstemp(suffix=".npy.tmp", dir=output_dir)
+    os.close(fd)
+    try:
+        stack = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.uint8, shape=(len(filenames), height, width)
+        )
+
+        def read_layer(i):
+            # GDAL releases the GIL while decoding, so the reads overlap
+            with rxr.open_rasterio(filenames[i], chunks=None) as layer:
+                stack[i] = layer.squeeze().values
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(read_layer, range(len(filenames))))
+
+        stack.flush()
+        del stack
+        os.chmod(tmp_path, 0o644)  # mkstemp creates files readable by the owner only
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    # Written last, so an interrupted build is never mistaken for a current one
+    fd, tmp_path = tempfile.mkstemp(suffix=".txt.tmp", dir=output_dir)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write("\n".join(data_list.Layer) + "\n")
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, names_path)
+
+
+if __name__ == "__main__":
+    build_layer_stack(pd.read_excel(DATA_LIST_PATH))